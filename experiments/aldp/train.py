@@ -3,12 +3,14 @@ import argparse
 import os
 import torch
 import numpy as np
+import pandas as pd
 
 import normflows as nf
 import boltzgen as bg
 
 from time import time
-from fab.utils.training import load_config
+from pathlib import Path
+from fab.utils.training import load_config, Prefetcher, AsyncCheckpointWriter
 from fab.sampling_methods.transition_operators import HamiltonianMonteCarlo, Metropolis
 from fab.utils.aldp import evaluate_aldp
 from fab.utils.aldp import filter_chirality
@@ -35,7 +37,12 @@ parser.add_argument('--mode', type=str, default='gpu',
                     help='Compute mode, can be cpu, or gpu')
 parser.add_argument('--precision', type=str, default='double',
                     help='Precision to be used for computation, '
-                         'can be float, double, or mixed')
+                         'can be float, double, or mixed_bf16')
+parser.add_argument("--compile", action="store_true",
+                    help='Flag whether to compile the flow with torch.compile')
+parser.add_argument('--compile_mode', type=str, default='default',
+                    help='Mode of torch.compile, can be default, reduce-overhead, '
+                         'or max-autotune')
 
 args = parser.parse_args()
 
@@ -50,10 +57,16 @@ if args.precision == 'double':
 seed = config['training']['seed']
 torch.manual_seed(seed)
 
+# Fused and multi-tensor (foreach) implementations require PyTorch 2.0
+torch_2 = int(torch.__version__.split('.')[0]) >= 2
+
 # GPU usage
 use_gpu = not args.mode == 'cpu' and torch.cuda.is_available()
 device = torch.device('cuda' if use_gpu else 'cpu')
 
+# Mixed precision: weights are kept in float32, forward passes run in bfloat16
+use_autocast = args.precision == 'mixed_bf16' and use_gpu
+
 # Load data
 path = config['data']['test']
 test_data = torch.load(path)
@@ -66,6 +79,20 @@ test_data = test_data.to(device)
 
 # Set up model
 model = make_aldp_model(config, device)
+if args.compile:
+    # The methods are compiled in place, so the state dict and hence the checkpoints
+    # are unaffected. The transition operator keeps the uncompiled log prob.
+    torch._dynamo.config.cache_size_limit = 64
+    nf_model = model.flow._nf_model
+    nf_model.log_prob = torch.compile(nf_model.log_prob, mode=args.compile_mode)
+    nf_model.sample = torch.compile(nf_model.sample, mode=args.compile_mode)
+    # The coordinate transform is evaluated at every AIS step, while the energies are
+    # computed by OpenMM. The transform is called repeatedly within a step while its
+    # outputs are still in use, hence CUDA graphs are not used for it.
+    coordinate_transform = model.target_distribution.coordinate_transform
+    coordinate_transform.forward = torch.compile(coordinate_transform.forward)
+# CUDA graphs are used by the reduce-overhead mode, which needs to know where a step begins
+use_cudagraphs = args.compile and args.compile_mode == 'reduce-overhead' and use_gpu
 
 # Prepare output directories
 root = config['training']['save_root']
@@ -79,8 +106,7 @@ log_dir_ais = os.path.join(log_dir, 'ais')
 # Create dirs if not existent
 for dir in [cp_dir, plot_dir, log_dir, plot_dir_flow,
             plot_dir_ais, log_dir_flow, log_dir_ais]:
-    if not os.path.isdir(dir):
-        os.mkdir(dir)
+    Path(dir).mkdir(parents=True, exist_ok=True)
 
 # Initialize optimizer and its parameters
 lr = config['training']['learning_rate']
@@ -89,7 +115,10 @@ optimizer_name = 'adam' if not 'optimizer' in config['training'] \
     else config['training']['optimizer']
 optimizer_param = model.parameters()
 if optimizer_name == 'adam':
-    optimizer = torch.optim.Adam(optimizer_param, lr=lr, weight_decay=weight_decay)
+    # Use the fused CUDA implementation if possible
+    adam_kwargs = {'fused': use_gpu} if torch_2 else {}
+    optimizer = torch.optim.Adam(optimizer_param, lr=lr, weight_decay=weight_decay,
+                                 **adam_kwargs)
 elif optimizer_name == 'adamax':
     optimizer = torch.optim.Adamax(optimizer_param, lr=lr, weight_decay=weight_decay)
 else:
@@ -124,8 +153,11 @@ log_iter = config['training']['log_iter']
 checkpoint_iter = config['training']['checkpoint_iter']
 
 batch_size = config['training']['batch_size']
-loss_hist = np.zeros((0, 2))
-ess_hist = np.zeros((0, 3))
+# Preallocate logs, the cursors point to the next row to be written
+loss_hist = np.empty((max_iter, 2), dtype=np.float64)
+loss_cursor = 0
+ess_hist = np.empty((max_iter // log_iter + 1, 3), dtype=np.float64)
+ess_cursor = 0
 eval_samples = config['training']['eval_samples']
 eval_samples_flow = len(test_data)
 filter_chirality_eval = 'eval' in config['training']['filter_chirality']
@@ -134,8 +166,10 @@ filter_chirality_train = 'train' in config['training']['filter_chirality']
 max_grad_norm = None if not 'max_grad_norm' in config['training'] \
     else config['training']['max_grad_norm']
 grad_clipping = max_grad_norm is not None
+clip_kwargs = {'foreach': True} if torch_2 else {}
 if grad_clipping:
-    grad_norm_hist = np.zeros((0, 2))
+    grad_norm_hist = np.empty((max_iter, 2), dtype=np.float64)
+    grad_norm_cursor = 0
 
 # Set parameters for training
 ndim = 60
@@ -156,7 +190,7 @@ if loss_type == 'forward_kl' or lam_fkld is not None:
     train_loader = torch.utils.data.DataLoader(train_data, batch_size=batch_size,
                                                shuffle=True, pin_memory=True,
                                                drop_last=True, num_workers=4)
-    train_iter = iter(train_loader)
+    train_iter = Prefetcher(train_loader, device)
 
 # Resume training if needed
 start_iter = 0
@@ -178,21 +212,23 @@ if args.resume:
         if os.path.exists(warmup_scheduler_path):
             warmup_scheduler.load_state_dict(torch.load(warmup_scheduler_path))
         # Load logs
-        log_labels = ['loss', 'ess']
-        log_hists = [loss_hist, ess_hist]
+        log_hists = {'loss': loss_hist, 'ess': ess_hist}
         if grad_clipping:
-            log_labels.append('grad_norm')
-            log_hists.append(grad_norm_hist)
-        for log_label, log_hist in zip(log_labels, log_hists):
+            log_hists['grad_norm'] = grad_norm_hist
+        log_cursors = {}
+        for log_label, log_hist in log_hists.items():
             log_path = os.path.join(log_dir, log_label + '.csv')
             if os.path.exists(log_path):
-                log_hist_ = np.loadtxt(log_path, delimiter=',', skiprows=1)
-                if log_hist_.ndim == 1:
-                    log_hist_ = log_hist_[None, :]
-                log_hist.resize(*log_hist_.shape, refcheck=False)
-                log_hist[:, :] = log_hist_
-                log_hist.resize(np.sum(log_hist_[:, 0] <= start_iter), log_hist_.shape[1],
-                                refcheck=False)
+                # The C parser is much faster than np.loadtxt and always returns a 2D array
+                log_hist_ = pd.read_csv(log_path, engine='c').to_numpy(dtype=np.float64)
+                # Only keep entries up to the checkpoint
+                log_hist_ = log_hist_[log_hist_[:, 0] <= start_iter]
+                log_hist[:len(log_hist_)] = log_hist_
+                log_cursors[log_label] = len(log_hist_)
+        loss_cursor = log_cursors.get('loss', loss_cursor)
+        ess_cursor = log_cursors.get('ess', ess_cursor)
+        if grad_clipping:
+            grad_norm_cursor = log_cursors.get('grad_norm', grad_norm_cursor)
 
 # Setup replay buffer
 if 'replay_buffer' in config['training']:
@@ -219,7 +255,8 @@ if 'replay_buffer' in config['training']:
 
         buffer = PrioritisedReplayBuffer(dim=ndim, max_length=rb_config['max_length'] * batch_size,
                                          min_sample_length=rb_config['min_length'] * batch_size,
-                                         initial_sampler=initial_sampler, device=str(device))
+                                         initial_sampler=initial_sampler, device=str(device),
+                                         compile_sample=args.compile)
 
         if os.path.exists(buffer_path):
             buffer.load(buffer_path)
@@ -266,95 +303,168 @@ if 'replay_buffer' in config['training']:
 alpha = None if not 'alpha' in config['fab'] else config['fab']['alpha']
 model.set_ais_target(min_is_target=min_is_target)
 
+# Draw AIS samples and map them back from the periodic interval the flow ends in
+periodic_wrap = model.flow._nf_model.flows[-1]
+def sample_ais_transformed(num_samples):
+    # Only the gradients w.r.t. the positions are needed, which HMC enables locally
+    with torch.no_grad():
+        x = model.annealed_importance_sampler.sample_and_log_weights(num_samples,
+                                                                     logging=False)[0].x
+        z, _ = periodic_wrap.inverse(x)
+    return z
+
+# Maximum number of samples drawn from the flow at once during evaluation
+MAX_EVAL_SAMPLE_CHUNK = 8192
+
+# Buffers for the evaluation samples, reused at every checkpoint
+z_samples_flow_buf = torch.empty(eval_samples_flow, ndim, device=device, dtype=test_data.dtype)
+z_samples_ais_buf = torch.empty(eval_samples, ndim, device=device, dtype=test_data.dtype)
+
+def fill_eval_samples(z_samples, sample_fn):
+    """Fill the buffer z_samples in place with samples drawn in batches by sample_fn, which
+    gets the number of samples still missing. Samples are optionally filtered by chirality."""
+    n_samples = 0
+    while n_samples < len(z_samples):
+        z_ = sample_fn(len(z_samples) - n_samples)
+        if filter_chirality_eval:
+            ind_L = filter_chirality(z_)
+            if torch.mean(1. * ind_L) > 0.1:
+                z_ = z_[ind_L, :]
+        ns = min(len(z_), len(z_samples) - n_samples)
+        z_samples[n_samples:n_samples + ns] = z_[:ns]
+        n_samples += ns
+    return z_samples
+
+# Losses and gradient norms are kept on the device and only copied to the
+# host when they are logged
+loss_buf = torch.empty(log_iter, device=device)
+n_buf = 0
+if grad_clipping:
+    grad_norm_buf = torch.empty(log_iter, device=device)
+    grad_norm_mask = np.zeros(log_iter, dtype=bool)  # steps which were not skipped
+
+# Optimizer and scheduler states are written in the background
+checkpoint_writer = AsyncCheckpointWriter()
+
+# Log files are only appended to during training. They are rewritten once here, which
+# drops entries after the checkpoint when resuming.
+def open_log(log_label, header, log_hist):
+    log_file = open(os.path.join(log_dir, log_label + '.csv'), 'w')
+    np.savetxt(log_file, log_hist, delimiter=',', header=header, comments='')
+    log_file.flush()
+    return log_file
+
+def append_log(log_file, log_rows):
+    np.savetxt(log_file, log_rows, delimiter=',')
+    log_file.flush()
+
+loss_file = open_log('loss', 'it,loss', loss_hist[:loss_cursor])
+ess_file = open_log('ess', 'it,flow,ais', ess_hist[:ess_cursor])
+if grad_clipping:
+    grad_norm_file = open_log('grad_norm', 'it,grad_norm', grad_norm_hist[:grad_norm_cursor])
+
+# Bind config values used within the training loop
+warmup_iter = config['training'].get('warmup_iter')
+adjust_step_size = config['fab']['adjust_step_size']
+use_snf = 'snf' in config['flow']
+use_prioritised_rb = use_rb and rb_config['type'] == 'prioritised'
+if use_rb:
+    rb_type = rb_config['type']
+    rb_n_updates = rb_config['n_updates']
+    rb_clip_w_frac = rb_config.get('clip_w_frac')
+    rb_max_adjust_w_clip = rb_config.get('max_adjust_w_clip')
+
 # Start training
 start_time = time()
 
 for it in range(start_iter, max_iter):
-    # Get loss
+    # Outputs of the CUDA graphs from the previous iteration may be overwritten from here on
+    if use_cudagraphs:
+        torch.compiler.cudagraph_mark_step_begin()
+
+    # Get batch of training data
     if loss_type == 'forward_kl' or lam_fkld is not None:
-        try:
-            x = next(train_iter)
-        except StopIteration:
-            train_iter = iter(train_loader)
-            x = next(train_iter)
-        x = x.to(device, non_blocking=True)
-        if lam_fkld is None:
-            loss = model.loss(x)
-        else:
-            loss = model.loss(batch_size) + lam_fkld * model.forward_kl(x)
-    elif use_rb:
-        if rb_config['type'] == 'uniform':
-            if it % rb_config['n_updates'] == 0:
-                # Sample
-                point_ais, log_w_ais = model.annealed_importance_sampler.\
-                    sample_and_log_weights(batch_size, logging=False)
-                # Filter chirality
-                if filter_chirality_train:
-                    ind_L = filter_chirality(point_ais.x)
-                    if torch.mean(1. * ind_L) > 0.1:
-                        point_ais = point_ais[ind_L, :]
-                        log_w_ais = log_w_ais[ind_L]
-                # Optionally do clipping
-                if rb_config['clip_w_frac'] is not None:
-                    k = max(2, int(rb_config['clip_w_frac'] * log_w_ais.shape[0]))
-                    max_log_w = torch.min(torch.topk(log_w_ais, k, dim=0).values)
-                    log_w_ais = torch.clamp_max(log_w_ais, max_log_w)
-                # Compute loss
-                loss = model.fab_ub_alpha_div_loss_inner(point_ais, log_w_ais)
-                # Sample from buffer
-                buffer_sample = buffer.sample_n_batches(batch_size=batch_size,
-                                                        n_batches=rb_config['n_updates'] - 1)
-                buffer_iter = iter(buffer_sample)
-                # Add sample to buffer
-                buffer.add(point_ais.x, log_w_ais)
+        x = next(train_iter)
+
+    # Get loss
+    with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=use_autocast):
+        if loss_type == 'forward_kl' or lam_fkld is not None:
+            if lam_fkld is None:
+                loss = model.loss(x)
             else:
-                x, log_w = next(buffer_iter)
-                log_q = model.flow.log_prob(x)
-                log_p = model.target_distribution.log_prob(x)
-                loss = model.fab_ub_alpha_div_loss_inner(log_q, log_p, log_w)
-        elif rb_config['type'] == 'prioritised':
-            if it % rb_config['n_updates'] == 0:
-                # Sample
-                point_ais, log_w_ais = model.annealed_importance_sampler.\
-                    sample_and_log_weights(batch_size, logging=False)
-                # Filter chirality
-                if filter_chirality_train:
-                    ind_L = filter_chirality(point_ais.x)
-                    if torch.mean(1. * ind_L) > 0.1:
-                        point_ais = point_ais[ind_L]
-                        log_w_ais = log_w_ais[ind_L]
-                # Add sample to buffer
-                buffer.add(point_ais.x, log_w_ais.detach(), point_ais.log_q)
-                # Sample from buffer
-                buffer_sample = buffer.sample_n_batches(batch_size=batch_size,
-                                                        n_batches=rb_config['n_updates'])
-                buffer_iter = iter(buffer_sample)
-
-            # Get batch from buffer
-            x, log_w, log_q_old, indices = next(buffer_iter)
-            x, log_w, log_q_old, indices = x.to(device), log_w.to(device), \
-                                           log_q_old.to(device), indices.to(device)
-            log_q_x = model.flow.log_prob(x)
-            # Adjustment to account for change to theta since sample was last added/adjusted
-            log_w_adjust = (1 - alpha) * (log_q_x.detach() - log_q_old)
-            w_adjust = torch.clip(torch.exp(log_w_adjust), max=rb_config['max_adjust_w_clip'])
-            # Manually calculate the new form of the loss
-            loss = - torch.mean(w_adjust * log_q_x)
-            # Adjust buffer samples
-            buffer.adjust(log_w_adjust, log_q_x.detach(), indices)
+                loss = model.loss(batch_size) + lam_fkld * model.forward_kl(x)
+        elif use_rb:
+            if rb_type == 'uniform':
+                if it % rb_n_updates == 0:
+                    # Sample
+                    point_ais, log_w_ais = model.annealed_importance_sampler.\
+                        sample_and_log_weights(batch_size, logging=False)
+                    # Filter chirality
+                    if filter_chirality_train:
+                        ind_L = filter_chirality(point_ais.x)
+                        if torch.mean(1. * ind_L) > 0.1:
+                            point_ais = point_ais[ind_L, :]
+                            log_w_ais = log_w_ais[ind_L]
+                    # Optionally do clipping
+                    if rb_clip_w_frac is not None:
+                        k = max(2, int(rb_clip_w_frac * log_w_ais.shape[0]))
+                        max_log_w = torch.min(torch.topk(log_w_ais, k, dim=0).values)
+                        log_w_ais = torch.clamp_max(log_w_ais, max_log_w)
+                    # Compute loss
+                    loss = model.fab_ub_alpha_div_loss_inner(point_ais, log_w_ais)
+                    # Sample from buffer
+                    buffer_sample = buffer.sample_n_batches(batch_size=batch_size,
+                                                            n_batches=rb_n_updates - 1)
+                    buffer_iter = iter(buffer_sample)
+                    # Add sample to buffer
+                    buffer.add(point_ais.x, log_w_ais)
+                else:
+                    x, log_w = next(buffer_iter)
+                    log_q = model.flow.log_prob(x)
+                    log_p = model.target_distribution.log_prob(x)
+                    loss = model.fab_ub_alpha_div_loss_inner(log_q, log_p, log_w)
+            elif rb_type == 'prioritised':
+                if it % rb_n_updates == 0:
+                    # Sample
+                    point_ais, log_w_ais = model.annealed_importance_sampler.\
+                        sample_and_log_weights(batch_size, logging=False)
+                    # Filter chirality
+                    if filter_chirality_train:
+                        ind_L = filter_chirality(point_ais.x)
+                        if torch.mean(1. * ind_L) > 0.1:
+                            point_ais = point_ais[ind_L]
+                            log_w_ais = log_w_ais[ind_L]
+                    # Add sample to buffer
+                    buffer.add(point_ais.x, log_w_ais.detach(), point_ais.log_q)
+                    # Sample from buffer
+                    buffer_sample = buffer.sample_n_batches(batch_size=batch_size,
+                                                            n_batches=rb_n_updates)
+                    buffer_iter = iter(buffer_sample)
+
+                # Get batch from buffer
+                x, log_w, log_q_old, indices = next(buffer_iter)
+                x, log_w, log_q_old, indices = x.to(device), log_w.to(device), \
+                                               log_q_old.to(device), indices.to(device)
+                log_q_x = model.flow.log_prob(x)
+                # Adjustment to account for change to theta since sample was last added/adjusted
+                log_w_adjust = (1 - alpha) * (log_q_x.detach() - log_q_old)
+                w_adjust = torch.clip(torch.exp(log_w_adjust), max=rb_max_adjust_w_clip)
+                # Manually calculate the new form of the loss
+                loss = - torch.mean(w_adjust * log_q_x)
+                # Adjust buffer samples
+                buffer.adjust(log_w_adjust, log_q_x.detach(), indices)
 
-    else:
-        loss = model.loss(batch_size)
+        else:
+            loss = model.loss(batch_size)
 
     # Make step
-    if not torch.isnan(loss) and not torch.isinf(loss):
+    if torch.isfinite(loss):
         loss.backward()
         if grad_clipping:
             grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       max_grad_norm)
-            grad_norm_append = np.array([[it + 1, grad_norm.item()]])
-            grad_norm_hist = np.concatenate([grad_norm_hist,
-                                             grad_norm_append])
+                                                       max_grad_norm, **clip_kwargs)
+            grad_norm_buf[n_buf] = grad_norm.detach()
+            grad_norm_mask[n_buf] = True
         optimizer.step()
 
     # Update Lipschitz constant if flows are residual
@@ -362,116 +472,116 @@ for it in range(start_iter, max_iter):
         nf.utils.update_lipschitz(model, 5)
 
     # Log loss
-    loss_append = np.array([[it + 1, loss.item()]])
-    loss_hist = np.concatenate([loss_hist, loss_append])
+    loss_buf[n_buf] = loss.detach()
+    n_buf += 1
 
     # Clear gradients
-    nf.utils.clear_grad(model)
+    optimizer.zero_grad(set_to_none=True)
 
     # Update lr scheduler
     if lr_scheduler is not None and (it + 1) % lr_step == 0:
         lr_scheduler.step()
 
     # Do lr warmup if needed
-    if lr_warmup and it <= config['training']['warmup_iter']:
+    if lr_warmup and it <= warmup_iter:
         warmup_scheduler.step()
 
     # Save loss
     if (it + 1) % log_iter == 0 or it == max_iter - 1:
+        # Transfer buffered values to the host
+        buf_its = np.arange(it + 2 - n_buf, it + 2)
+        loss_hist[loss_cursor:loss_cursor + n_buf, 0] = buf_its
+        loss_hist[loss_cursor:loss_cursor + n_buf, 1] = loss_buf[:n_buf].cpu().numpy()
+        loss_cursor += n_buf
+        if grad_clipping:
+            step_mask = grad_norm_mask[:n_buf]
+            n_steps = np.sum(step_mask)
+            grad_norm_hist[grad_norm_cursor:grad_norm_cursor + n_steps, 0] = buf_its[step_mask]
+            grad_norm_hist[grad_norm_cursor:grad_norm_cursor + n_steps, 1] = \
+                grad_norm_buf[:n_buf].cpu().numpy()[step_mask]
+            grad_norm_cursor += n_steps
+            grad_norm_mask[:] = False
+
         # Loss
-        np.savetxt(os.path.join(log_dir, 'loss.csv'), loss_hist,
-                   delimiter=',', header='it,loss', comments='')
+        append_log(loss_file, loss_hist[loss_cursor - n_buf:loss_cursor])
+        n_buf = 0
         # Gradient clipping
         if grad_clipping:
-            np.savetxt(os.path.join(log_dir, 'grad_norm.csv'),
-                       grad_norm_hist, delimiter=',',
-                       header='it,grad_norm', comments='')
+            append_log(grad_norm_file,
+                       grad_norm_hist[grad_norm_cursor - n_steps:grad_norm_cursor])
 
         # Disable step size tuning while evaluating model
         model.transition_operator.set_eval_mode(True)
-        if use_rb and rb_config['type'] == 'prioritised':
+        if use_prioritised_rb:
             model.set_ais_target(min_is_target=False)
 
         # Effective sample size.
-        base_samples, base_log_w, ais_samples, ais_log_w = \
-            model.annealed_importance_sampler.generate_eval_data(8 * batch_size,
-                                                                 batch_size)
+        with torch.no_grad(), torch.autocast(device_type='cuda', dtype=torch.bfloat16,
+                                             enabled=use_autocast):
+            base_samples, base_log_w, ais_samples, ais_log_w = \
+                model.annealed_importance_sampler.generate_eval_data(8 * batch_size,
+                                                                     batch_size,
+                                                                     move_to_cpu=False)
         # Re-enable step size tuning
-        if config['fab']['adjust_step_size']:
+        if adjust_step_size:
             model.transition_operator.set_eval_mode(False)
-        if use_rb and rb_config['type'] == 'prioritised':
+        if use_prioritised_rb:
             model.set_ais_target(min_is_target=True)
 
-        ess_append = np.array([[it + 1, effective_sample_size(base_log_w, normalised=False),
-                                effective_sample_size(ais_log_w, normalised=False)]])
-        ess_hist = np.concatenate([ess_hist, ess_append])
-        np.savetxt(os.path.join(log_dir, 'ess.csv'), ess_hist,
-                   delimiter=',', header='it,flow,ais', comments='')
-        if use_gpu:
-            torch.cuda.empty_cache()
+        # Log weights are reduced in float32 even if they were computed in bfloat16
+        if use_autocast:
+            base_log_w, ais_log_w = base_log_w.float(), ais_log_w.float()
+        ess_hist[ess_cursor] = (it + 1,
+                                effective_sample_size(base_log_w, normalised=False).item(),
+                                effective_sample_size(ais_log_w, normalised=False).item())
+        ess_cursor += 1
+        append_log(ess_file, ess_hist[ess_cursor - 1:ess_cursor])
 
     if (it + 1) % checkpoint_iter == 0 or it == max_iter - 1:
         # Save checkpoint
         model.save(os.path.join(cp_dir, 'model_%07i.pt' % (it + 1)))
-        torch.save(optimizer.state_dict(),
-                   os.path.join(cp_dir, 'optimizer.pt'))
+        checkpoint_writer.save(optimizer.state_dict(),
+                               os.path.join(cp_dir, 'optimizer.pt'))
         if lr_scheduler is not None:
-            torch.save(lr_scheduler.state_dict(),
-                       os.path.join(cp_dir, 'lr_scheduler.pt'))
+            checkpoint_writer.save(lr_scheduler.state_dict(),
+                                   os.path.join(cp_dir, 'lr_scheduler.pt'))
         if lr_warmup:
-            torch.save(warmup_scheduler.state_dict(),
-                       os.path.join(cp_dir, 'warmup_scheduler.pt'))
+            checkpoint_writer.save(warmup_scheduler.state_dict(),
+                                   os.path.join(cp_dir, 'warmup_scheduler.pt'))
 
         # Disable step size tuning while evaluating model
         model.transition_operator.set_eval_mode(True)
-        if use_rb and rb_config['type'] == 'prioritised':
+        if use_prioritised_rb:
             buffer.save(os.path.join(cp_dir, 'buffer.pt'))
             model.set_ais_target(min_is_target=False)  # Eval over p and not p^2/q.
 
         # Draw samples
-        z_samples = torch.zeros(0, ndim).to(device)
-        while z_samples.shape[0] < eval_samples_flow:
-            with torch.no_grad():
-                z_ = model.flow.sample((batch_size,))
-            if filter_chirality_eval:
-                ind_L = filter_chirality(z_)
-                if torch.mean(1. * ind_L) > 0.1:
-                    z_ = z_[ind_L, :]
-            z_samples = torch.cat((z_samples, z_.detach()))
-        z_samples = z_samples[:eval_samples_flow, :]
+        with torch.no_grad():
+            fill_eval_samples(z_samples_flow_buf,
+                              lambda n: model.flow.sample((min(MAX_EVAL_SAMPLE_CHUNK, n),)))
 
         # Evaluate model and save plots
-        if 'snf' in config['flow']:
+        if use_snf:
             log_prob_fn = lambda a: a.new_zeros(a.shape[0])
         else:
             log_prob_fn = model.flow.log_prob
-        evaluate_aldp(z_samples, test_data, log_prob_fn,
+        evaluate_aldp(z_samples_flow_buf, test_data, log_prob_fn,
                       model.target_distribution.coordinate_transform, it, metric_dir=log_dir_flow,
                       plot_dir=plot_dir_flow)
 
         # Draw samples
-        z_samples = torch.zeros(0, ndim).to(device)
-        while z_samples.shape[0] < eval_samples:
-            z_ = model.annealed_importance_sampler.sample_and_log_weights(batch_size,
-                                                                              logging=False)[0].x
-            z_, _ = model.flow._nf_model.flows[-1].inverse(z_.detach())
-            if filter_chirality_eval:
-                ind_L = filter_chirality(z_)
-                if torch.mean(1. * ind_L) > 0.1:
-                    z_ = z_[ind_L, :]
-            z_samples = torch.cat((z_samples, z_.detach()))
+        fill_eval_samples(z_samples_ais_buf, lambda n: sample_ais_transformed(batch_size))
 
         # Evaluate model and save plots
         if eval_samples > 0:
-            z_samples = z_samples[:eval_samples, :]
-            evaluate_aldp(z_samples, test_data, log_prob_fn,
+            evaluate_aldp(z_samples_ais_buf, test_data, log_prob_fn,
                           model.target_distribution.coordinate_transform, it, metric_dir=log_dir_ais,
                           plot_dir=plot_dir_ais)
 
         # Re-enable step size tuning
-        if config['fab']['adjust_step_size']:
+        if adjust_step_size:
             model.transition_operator.set_eval_mode(False)
-        if use_rb and rb_config['type'] == 'prioritised':
+        if use_prioritised_rb:
             model.set_ais_target(min_is_target=True)
 
     # End job if necessary
@@ -480,3 +590,10 @@ for it in range(start_iter, max_iter):
         num_cp = (it + 1 - start_iter) / checkpoint_iter
         if num_cp > .5 and time_past * (1 + 1 / num_cp) > args.tlimit:
             break
+
+# Make sure all checkpoints are written before exiting
+checkpoint_writer.join()
+loss_file.close()
+ess_file.close()
+if grad_clipping:
+    grad_norm_file.close()
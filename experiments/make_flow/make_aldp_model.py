@@ -11,6 +11,28 @@ from fab import FABModel
 from fab.core import ALPHA_DIV_TARGET_LOSSES
 
 
+def _build_periodic_indices(target, ind_circ_dih, ndim=60):
+    """Get the indices of the circular coordinates in the flow's input and their bounds.
+    The indices are computed on the device of the coordinate transform and only the final
+    indices are moved to the CPU, while the bounds stay on the device."""
+    transform = target.coordinate_transform.transform
+    ncarts = transform.len_cart_inds
+    permute_inv = transform.permute_inv
+    dih_ind_ = transform.ic_transform.dih_indices
+    std_dih = transform.ic_transform.std_dih
+    device = permute_inv.device
+
+    ind = torch.cat([torch.arange(3 * ncarts - 6, device=device),
+                     torch.full((6,), -1, dtype=torch.long, device=device),
+                     torch.arange(3 * ncarts - 6, ndim, device=device)])
+    ind = ind[permute_inv]
+    dih_ind = ind[dih_ind_]
+
+    ind_circ = dih_ind[ind_circ_dih].cpu()
+    bound_circ = np.pi / std_dih[ind_circ_dih]
+    return ind_circ, bound_circ
+
+
 def make_aldp_model(config, device):
     # Set seed
     seed = config['training']['seed']
@@ -41,21 +63,10 @@ def make_aldp_model(config, device):
     flow_type = config['flow']['type']
     ndim = 60
 
-    ncarts = target.coordinate_transform.transform.len_cart_inds
-    permute_inv = target.coordinate_transform.transform.permute_inv.cpu().numpy()
-    dih_ind_ = target.coordinate_transform.transform.ic_transform.dih_indices.cpu().numpy()
-    std_dih = target.coordinate_transform.transform.ic_transform.std_dih.cpu()
-
-    ind = np.arange(ndim)
-    ind = np.concatenate([ind[:3 * ncarts - 6], -np.ones(6, dtype=np.int), ind[3 * ncarts - 6:]])
-    ind = ind[permute_inv]
-    dih_ind = ind[dih_ind_]
-
-    ind_circ = dih_ind[ind_circ_dih]
-    bound_circ = np.pi / std_dih[ind_circ_dih]
+    ind_circ, bound_circ = _build_periodic_indices(target, ind_circ_dih, ndim)
 
-    tail_bound = 5. * torch.ones(ndim)
-    tail_bound[ind_circ] = bound_circ
+    tail_bound = torch.full((ndim,), 5., device=device)
+    tail_bound[ind_circ.to(device)] = bound_circ.to(tail_bound)
 
     circ_shift = None if not 'circ_shift' in config['flow'] \
         else config['flow']['circ_shift']
@@ -65,12 +76,12 @@ def make_aldp_model(config, device):
         base = nf.distributions.DiagGaussian(ndim,
                                              trainable=config['flow']['base']['learn_mean_var'])
     elif config['flow']['base']['type'] == 'gauss-uni':
-        base_scale = torch.ones(ndim)
+        base_scale = torch.ones(ndim, device=device)
         base_scale[ind_circ] = bound_circ * 2
         base = nf.distributions.UniformGaussian(ndim, ind_circ, scale=base_scale)
         base.shape = (ndim,)
     elif config['flow']['base']['type'] == 'resampled-gauss-uni':
-        base_scale = torch.ones(ndim)
+        base_scale = torch.ones(ndim, device=device)
         base_scale[ind_circ] = bound_circ * 2
         base_ = nf.distributions.UniformGaussian(ndim, ind_circ, scale=base_scale)
         pf = nf.utils.nn.PeriodicFeaturesCat(ndim, ind_circ, np.pi / bound_circ)
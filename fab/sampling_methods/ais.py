@@ -129,7 +129,8 @@ class AnnealedImportanceSampler:
         return torch.tensor(B_space)
 
 
-    def generate_eval_data(self, outer_batch_size: int, inner_batch_size: int) -> Tuple[
+    def generate_eval_data(self, outer_batch_size: int, inner_batch_size: int,
+                           move_to_cpu: bool = True) -> Tuple[
         torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
         """
         Generates a big batch of data for evaluate, by running multiple steps forward passes of
@@ -137,6 +138,9 @@ class AnnealedImportanceSampler:
         Args:
             outer_batch_size: Total number of evaluation points generated.
             inner_batch_size: Batch size during each forward pass of ais.
+            move_to_cpu: Whether to move the generated data to the CPU after each forward pass.
+                If False, the data stays on the device it was generated on, such that it can
+                be reduced there without synchronising after every batch.
 
         Returns:
             base_samples: Samples from the base (flow) distribution.
@@ -144,6 +148,10 @@ class AnnealedImportanceSampler:
             ais_samples: Samples from AIS.
             ais_log_w: Log importance weights from AIS.
         """
+        def to_output(tensor: torch.Tensor) -> torch.Tensor:
+            tensor = tensor.detach()
+            return tensor.cpu() if move_to_cpu else tensor
+
         base_samples = []
         base_log_w_s = []
         ais_samples = []
@@ -164,8 +172,8 @@ class AnnealedImportanceSampler:
                                                           descriptor="chain init")
 
             # append base samples and log probs
-            base_samples.append(point.x.detach().cpu())
-            base_log_w_s.append(base_log_w.detach().cpu())
+            base_samples.append(to_output(point.x))
+            base_log_w_s.append(to_output(base_log_w))
 
             log_w = get_intermediate_log_prob(point, self.B_space[1], self.alpha,
                                               self.p_target) - point.log_q
@@ -176,8 +184,8 @@ class AnnealedImportanceSampler:
             point, log_w = self._remove_nan_and_infs(point, log_w, descriptor="chain end",
                                                      raise_exception=False)
             # append ais samples and log probs
-            ais_samples.append(point.x.detach().cpu())
-            ais_log_w.append(log_w.detach().cpu())
+            ais_samples.append(to_output(point.x))
+            ais_log_w.append(to_output(log_w))
 
 
         base_samples = torch.cat(base_samples, dim=0)
@@ -156,8 +156,9 @@ class PrioritisedBufferTrainer:
             mini_dataset = self.buffer.sample_n_batches(
                     batch_size=batch_size, n_batches=self.n_batches_buffer_sampling)
             for (x, log_w, log_q_old, indices) in mini_dataset:
-                x, log_w, log_q_old, indices = x.to(self.flow_device), log_w.to(self.flow_device), \
-                                               log_q_old.to(self.flow_device), indices.to(self.flow_device)
+                # indices stay on the buffer device, as they are only passed back to the buffer.
+                x, log_w, log_q_old = x.to(self.flow_device), log_w.to(self.flow_device), \
+                                      log_q_old.to(self.flow_device)
                 self.optimizer.zero_grad()
                 log_q_x = self.model.flow.log_prob(x)
                 # adjustment to account for change to theta since sample was last added/adjusted
@@ -183,7 +184,8 @@ class PrioritisedBufferTrainer:
                 # Adjust log weights in the buffer on the fly.
                 if not self.w_adjust_in_buffer_after_update:
                     with torch.no_grad():
-                        self.buffer.adjust(log_w_adjust, log_q_x, indices)
+                        self.buffer.adjust(log_w_adjust.to(self.buffer.device),
+                                           log_q_x.to(self.buffer.device), indices)
 
 
             info.update(loss=loss.cpu().detach().item(),
@@ -202,12 +204,12 @@ class PrioritisedBufferTrainer:
                     for (x, log_w, log_q_old, indices) in mini_dataset:
                         """Adjust importance weights in the buffer for the points in the 
                         `mini_dataset` to account for the updated theta."""
-                        x, log_w, log_q_old, indices = x.to(self.flow_device), log_w.to(
-                            self.flow_device), log_q_old.to(self.flow_device), indices.to(
-                            self.flow_device)
+                        x, log_w, log_q_old = x.to(self.flow_device), log_w.to(
+                            self.flow_device), log_q_old.to(self.flow_device)
                         log_q_new = self.model.flow.log_prob(x)
                         log_w_adjust_insert = (1 - self.alpha) * (log_q_new - log_q_old)
-                        self.buffer.adjust(log_w_adjust_insert, log_q_new, indices)
+                        self.buffer.adjust(log_w_adjust_insert.to(self.buffer.device),
+                                           log_q_new.to(self.buffer.device), indices)
                     info.update(
                         log_w_adjust_insert_mean = torch.mean
                         (log_w_adjust_insert).detach().cpu().item(),
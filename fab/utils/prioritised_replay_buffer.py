@@ -1,19 +1,26 @@
-from typing import NamedTuple, Tuple, Iterable, Callable
+from typing import NamedTuple, Tuple, Iterable, Callable, Optional
 import torch
 
+from fab.utils.sum_tree import LogSumTree
+
 class ReplayData(NamedTuple):
     """Log weights and samples generated by annealed importance sampling."""
     x: torch.Tensor
     log_w: torch.Tensor
     log_q_old: torch.Tensor
 
-def sample_without_replacement(logits: torch.Tensor, n: int) -> torch.Tensor:
+def sample_without_replacement(logits: torch.Tensor, n: int,
+                               scratch: Optional[torch.Tensor] = None) -> torch.Tensor:
     # https://timvieira.github.io/blog/post/2014/07/31/gumbel-max-trick/
-    z = torch.distributions.Gumbel(torch.tensor(0.0), torch.tensor(1.0)).sample(
-        logits.shape).to(logits.device)
-    topk = torch.topk(z + logits, n, sorted=False)
+    # The Gumbel noise -log(-log(u)) is drawn directly on the device of the logits. If `scratch`
+    # (same shape as logits) is given, the perturbed logits are computed in it in-place.
+    if scratch is None:
+        scratch = torch.empty_like(logits)
+    z = scratch.uniform_().clamp_min_(torch.finfo(logits.dtype).tiny)
+    z.log_().neg_().log_().neg_().add_(logits)
+    topk = torch.topk(z, n, sorted=False)
     indices = topk.indices
-    indices = indices[torch.randperm(n).to(indices.device)]
+    indices = indices[torch.randperm(n, device=indices.device)]
     return indices
 
 
@@ -25,6 +32,10 @@ class PrioritisedReplayBuffer:
                  device: str = "cpu",
                  sample_with_replacement: bool = False,
                  fill_buffer_during_init: bool = True,
+                 compile_sample: bool = False,
+                 x_dtype: Optional[torch.dtype] = None,
+                 uniform_sample_threshold: Optional[float] = None,
+                 x_storage_device: Optional[str] = None,
                  ):
         """
         Create prioritised replay buffer for batched sampling and adding of data.
@@ -36,9 +47,24 @@ class PrioritisedReplayBuffer:
                 the min sample length. The initialised flow + AIS may be used here,
                 or we may desire to use AIS with more distributions to give the flow a "good start".
             device: replay buffer device
-            sample_with_replacement: Whether to sample from the buffer with replacement.
+            sample_with_replacement: Whether to sample from the buffer with replacement. If so, the
+                log weights are also kept in a `LogSumTree` so that sampling is O(batch_size log N).
             fill_buffer_during_init: Whether to use `initial_sampler` to fill the buffer initially.
-                If a checkpoint is going to be loaded then this should be set to False.
+                If a checkpoint is going to be loaded then this should be set to False. The initial
+                batches are concatenated before being added, so the fill temporarily needs about
+                twice the memory of the `min_sample_length` points it adds.
+            compile_sample: Whether to compile the index sampling and gathers in `sample` with
+                `torch.compile`, so that they are fused into fewer kernels.
+            x_dtype: If given, the dtype that x is stored in, for example torch.bfloat16 to halve
+                its memory footprint. Sampled x is cast back to the default dtype. log_w and log_q_old
+                always use the default dtype.
+            uniform_sample_threshold: If given, `sample` draws indices uniformly whenever the spread
+                max(log_w) - min(log_w) in the buffer is below this value, as the weighting is then
+                negligible. Checking the spread costs a reduction over the buffer and a host sync.
+            x_storage_device: If given, the device x is stored on, for example "cpu" to hold a
+                buffer that is larger than GPU memory. log_w and log_q_old are kept on `device`, and
+                only the sampled rows of x are copied to `device`. On the CPU, x is kept in pinned
+                memory when `device` is a CUDA device so that this copy is asynchronous.
 
         The `max_length` and `min_sample_length` should be sufficiently long to prevent overfitting
         to the replay data. For example, if `min_sample_length` is equal to the
@@ -49,108 +75,225 @@ class PrioritisedReplayBuffer:
         self.dim = dim
         self.max_length = max_length
         self.min_sample_length = min_sample_length
-        self.buffer = ReplayData(x=torch.zeros(self.max_length, dim).to(device),
-                              log_w=torch.zeros(self.max_length, ).to(device),
-                              log_q_old=torch.zeros(self.max_length, ).to(device))
-        self.possible_indices = torch.arange(self.max_length).to(device)
+        # x, log_w and log_q_old are the columns of a single (max_length, dim + 2) tensor, so that
+        # a sampled row is read, and an added row written, with a single gather/scatter. If x has
+        # its own dtype or device it is stored separately, and only log_w and log_q_old share a tensor.
+        self._packed = x_dtype is None and x_storage_device is None
+        if self._packed:
+            self._arena = torch.zeros(self.max_length, dim + 2, device=device)
+            x = self._arena[:, :dim]
+            self._log_w_column = dim
+        else:
+            self._arena = torch.zeros(self.max_length, 2, device=device)
+            x_storage_device = torch.device(x_storage_device or device)
+            pin_x = x_storage_device.type == 'cpu' and torch.device(device).type == 'cuda'
+            x = torch.zeros(self.max_length, dim, dtype=x_dtype, device=x_storage_device,
+                            pin_memory=pin_x)
+            self._log_w_column = 0
+        # (max_length, 2) view of the log_w and log_q_old columns.
+        self._logs = self._arena[:, self._log_w_column:self._log_w_column + 2]
+        self.buffer = ReplayData(x=x, log_w=self._logs[:, 0], log_q_old=self._logs[:, 1])
+        # Reused across calls to `sample` to hold the Gumbel perturbed log weights. Sampling with
+        # replacement goes through the sum tree instead, and does not need it.
+        self._scratch = None if sample_with_replacement else \
+            torch.empty(self.max_length, device=device)
         self.device = device
         self.current_index = 0
         self.is_full = False  # whether the buffer is full
         self.can_sample = False  # whether the buffer is full enough to begin sampling
         self.sample_with_replacement = sample_with_replacement
+        self.uniform_sample_threshold = uniform_sample_threshold
+        self._sum_tree = LogSumTree(self.max_length, device) if sample_with_replacement else None
+        # CPU data added to a CUDA buffer is copied and written on a side stream.
+        if torch.device(device).type == 'cuda':
+            self._copy_stream = torch.cuda.Stream(device)
+            self._add_event = torch.cuda.Event()
+        else:
+            self._copy_stream = None
+        # Dynamic shapes, as max_index grows until the buffer is full. The default mode is used
+        # rather than "reduce-overhead", as CUDA graph outputs are overwritten by the next call.
+        self._sample_impl = torch.compile(self._sample_impl, dynamic=True) if compile_sample \
+            else self._sample_impl
 
         if fill_buffer_during_init:
-            while self.can_sample is False:
-                # fill buffer up minimum length
+            # Draw batches (at least one) until there is enough data to fill the buffer up to the
+            # minimum length, then write them all with a single `add`. All batches are held until
+            # they are concatenated, so peak memory during the fill is about twice the filled data.
+            initial_batches = []
+            n_initial = 0
+            while not initial_batches or n_initial < self.min_sample_length:
                 x, log_w, log_q_old = initial_sampler()
-                self.add(x, log_w, log_q_old)
+                initial_batches.append((x, log_w, log_q_old))
+                n_initial += x.shape[0]
+            with torch.no_grad():
+                # Only the most recent max_length points would remain after a wrap around.
+                x, log_w, log_q_old = (torch.cat(tensors)[-self.max_length:]
+                                       for tensors in zip(*initial_batches))
+            self.add(x, log_w, log_q_old)
         else:
             print("Buffer not initialised, expected that checkpoint will be loaded.")
 
+    def _wait_for_add(self) -> None:
+        """Make the current stream wait for any write that `add` issued on the copy stream."""
+        if self._copy_stream is not None:
+            torch.cuda.current_stream(self.device).wait_event(self._add_event)
+
     @torch.no_grad()
     def add(self, x: torch.Tensor, log_w: torch.Tensor, log_q_old: torch.Tensor) -> None:
         """Add a new batch of generated data to the replay buffer"""
         batch_size = x.shape[0]
-        x = x.to(self.device)
-        log_w = log_w.to(self.device)
-        log_q_old = log_q_old.to(self.device)
-        indices = (torch.arange(batch_size) + self.current_index).to(self.device) % self.max_length
-        self.buffer.x[indices] = x
-        self.buffer.log_w[indices] = log_w
-        self.buffer.log_q_old[indices] = log_q_old
+        rows = torch.cat([x, log_w[:, None], log_q_old[:, None]], dim=1)
+        if self._copy_stream is not None and rows.device.type == 'cpu':
+            # Stage the data in pinned memory so that the host to device copy, and the write into
+            # the buffer, run asynchronously on the copy stream, overlapping with the current stream.
+            self._copy_stream.wait_stream(torch.cuda.current_stream(self.device))
+            with torch.cuda.stream(self._copy_stream):
+                self._write(rows.pin_memory())
+            self._add_event.record(self._copy_stream)
+        else:
+            # Order this write after any earlier asynchronous `add` to the same buffer.
+            self._wait_for_add()
+            self._write(rows)
         new_index = self.current_index + batch_size
-        if not self.is_full:
-            self.is_full = new_index >= self.max_length
-            self.can_sample = new_index >= self.min_sample_length
+        # Both flags stay True once set.
+        self.is_full = self.is_full or new_index >= self.max_length
+        self.can_sample = self.can_sample or new_index >= self.min_sample_length
         self.current_index = new_index % self.max_length
 
+    def _write(self, rows: torch.Tensor) -> None:
+        """Write a batch of (x, log_w, log_q_old) rows into the buffer, starting at `current_index`."""
+        batch_size = rows.shape[0]
+        # index_copy_ does not cast, so match the buffer dtype here. Copies to the CPU are kept
+        # blocking, as the data would otherwise be read before it arrives.
+        non_blocking = self._copy_stream is not None
+        x = rows[:, :self.dim]
+        rows = rows.to(self.device, self._arena.dtype, non_blocking=non_blocking)
+        indices = torch.arange(batch_size, device=self.device).add_(self.current_index
+                                                                     ).remainder_(self.max_length)
+        if self._packed:
+            self._arena.index_copy_(0, indices, rows)
+        else:
+            self._arena.index_copy_(0, indices, rows[:, self.dim:])
+            x_device = self.buffer.x.device
+            self.buffer.x.index_copy_(0, indices.to(x_device), x.to(x_device, self.buffer.x.dtype))
+        if self._sum_tree is not None:
+            self._sum_tree.update(indices, rows[:, self.dim])
+
     @torch.no_grad()
     def sample(self, batch_size: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
         """Return a batch of sampled data, if the batch size is specified then the batch will have a
         leading axis of length batch_size, otherwise the default self.batch_size will be used."""
         if not self.can_sample:
             raise Exception("Buffer must be at minimum length before calling sample")
+        self._wait_for_add()
         max_index = self.max_length if self.is_full else self.current_index
-        if self.sample_with_replacement:
-            indices = torch.distributions.Categorical(logits=self.buffer.log_w[:max_index]
-                                                      ).sample_n(batch_size)
+        uniform = False
+        if self.uniform_sample_threshold is not None:
+            min_log_w, max_log_w = torch.aminmax(self.buffer.log_w[:max_index])
+            uniform = (max_log_w - min_log_w).item() < self.uniform_sample_threshold
+        return self._sample_impl(batch_size, max_index, uniform)
+
+    def _sample_impl(self, batch_size: int, max_index: int, uniform: bool) -> \
+            Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        if uniform and self.sample_with_replacement:
+            indices = torch.randint(0, max_index, (batch_size,), device=self.device)
+        elif uniform:
+            indices = torch.randperm(max_index, device=self.device)[:batch_size]
+        elif self.sample_with_replacement:
+            # Leaves beyond max_index have never been written, so hold -inf and are not sampled.
+            indices = self._sum_tree.sample(batch_size)
+        else:
+            indices = sample_without_replacement(self.buffer.log_w[:max_index], batch_size,
+                                                 scratch=self._scratch[:max_index])
+        rows = self._arena.index_select(0, indices)
+        if self._packed:
+            # x is made contiguous as the flows may reshape it.
+            x = rows[:, :self.dim].contiguous()
         else:
-            indices = sample_without_replacement(self.buffer.log_w[:max_index], batch_size).to(self.device)
-        x, log_w, log_q_old, indices = self.buffer.x[indices], self.buffer.log_w[indices], \
-                                       self.buffer.log_q_old[indices], indices
+            x = self._gather_x(indices).to(rows.dtype)
+        log_w, log_q_old = rows[:, self._log_w_column], rows[:, self._log_w_column + 1]
         return x, log_w, log_q_old, indices
 
 
+    def _gather_x(self, indices: torch.Tensor) -> torch.Tensor:
+        """Gather rows of x, which may be stored on a different device, onto the buffer device."""
+        x_device = self.buffer.x.device
+        if x_device == indices.device:
+            return self.buffer.x.index_select(0, indices)
+        indices = indices.to(x_device)
+        if self.buffer.x.is_pinned():
+            # Gather into pinned memory so that the copy to the buffer device is asynchronous.
+            x = torch.empty((indices.shape[0], self.dim), dtype=self.buffer.x.dtype, pin_memory=True)
+            torch.index_select(self.buffer.x, 0, indices, out=x)
+            return x.to(self.device, non_blocking=True)
+        return self.buffer.x.index_select(0, indices).to(self.device)
+
     def sample_n_batches(self, batch_size: int, n_batches: int) -> \
             Iterable[Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]]:
         """Returns a list of batches."""
         x, log_w, log_q_old, indices = self.sample(batch_size*n_batches)
-        x_batches = torch.chunk(x, n_batches)
-        log_w_batches = torch.chunk(log_w, n_batches)
-        log_q_old_batches = torch.chunk(log_q_old, n_batches)
-        indices_batches = torch.chunk(indices, n_batches)
-        dataset = [(x, log_w, log_q_old, indxs) for x, log_w, log_q_old, indxs in zip(x_batches, log_w_batches,
-                                                                           log_q_old_batches, indices_batches)]
+        # The sample is exactly n_batches * batch_size long, so the batches are views along dim 0.
+        dataset = list(zip(x.view(n_batches, batch_size, self.dim),
+                           log_w.view(n_batches, batch_size),
+                           log_q_old.view(n_batches, batch_size),
+                           indices.view(n_batches, batch_size)))
         return dataset
 
     @torch.no_grad()
     def adjust(self, log_w_adjustment, log_q, indices):
         """Adjust log weights and log q to match new value of theta, this is typically performed
         over minibatches, rather than over the whole dataset at once."""
+        # All inputs must already be on the buffer device.
+        assert indices.device == log_w_adjustment.device == log_q.device == self._logs.device
+        self._wait_for_add()
         valid_adjustment = torch.isfinite(log_w_adjustment) & torch.isfinite(log_q)
-        log_w_adjustment, log_q, valid_indices = \
-            log_w_adjustment[valid_adjustment], log_q[valid_adjustment], indices[valid_adjustment]
-        valid_indices = valid_indices.to(self.device)
-        self.buffer.log_w[valid_indices] += log_w_adjustment.to(self.device)
-        self.buffer.log_q_old[valid_indices] = log_q.to(self.device)
-
         # Kill samples in the buffer for which the `log_w_adjustment` is invalid.
         # A common reason this can occur is if AIS discovers a point far outside the reasonable range of the problem.
         # Which causes nan log probs under the flow.
-        invalid_indices = indices[~valid_adjustment].to(self.device)
-        self.buffer.log_w[invalid_indices] = -torch.ones_like(self.buffer.log_w[invalid_indices])*(float("inf"))
+        # The update is done with torch.where rather than boolean masking, which would require a host sync.
+        # log_w and log_q_old are read and written together, with one gather and one scatter.
+        old_logs = self._logs.index_select(0, indices)
+        log_w = torch.where(valid_adjustment, old_logs[:, 0] + log_w_adjustment,
+                            torch.full_like(log_w_adjustment, -float("inf")))
+        log_q = torch.where(valid_adjustment, log_q, old_logs[:, 1])
+        self._logs.index_copy_(0, indices, torch.stack([log_w, log_q], dim=1).to(self._logs.dtype))
+        if self._sum_tree is not None:
+            self._sum_tree.update(indices, log_w)
 
 
     def save(self, path):
         """Save buffer to file."""
-        to_save = {'x': self.buffer.x.detach().cpu(),
-                   'log_w': self.buffer.log_w.detach().cpu(),
-                   'log_q_old': self.buffer.log_q_old.detach().cpu(),
-                   'current_index': self.current_index,
-                   'is_full': self.is_full,
-                   'can_sample': self.can_sample}
+        self._wait_for_add()
+        # The packed buffer is moved to the CPU with a single copy.
+        if self._packed:
+            to_save = {'arena': self._arena.cpu()}
+        else:
+            to_save = {'x': self.buffer.x.cpu(), 'logs': self._logs.cpu()}
+        to_save.update({'current_index': self.current_index,
+                        'is_full': self.is_full,
+                        'can_sample': self.can_sample})
         torch.save(to_save, path)
 
     def load(self, path):
         """Load buffer from file."""
         old_buffer = torch.load(path)
-        indices = torch.arange(self.max_length)
-        self.buffer.x[indices] = old_buffer['x'].to(self.device)
-        self.buffer.log_w[indices] = old_buffer['log_w'].to(self.device)
-        self.buffer.log_q_old[indices] = old_buffer['log_q_old'].to(self.device)
+        self._wait_for_add()
+        # Buffers saved packed or unpacked can be loaded into either layout, as can buffers saved
+        # with separate log_w and log_q_old tensors. copy_ moves and casts the tensors as needed.
+        if 'arena' in old_buffer:
+            x, logs = old_buffer['arena'][:, :self.dim], old_buffer['arena'][:, self.dim:]
+        elif 'logs' in old_buffer:
+            x, logs = old_buffer['x'], old_buffer['logs']
+        else:
+            x, logs = old_buffer['x'], torch.stack([old_buffer['log_w'], old_buffer['log_q_old']], dim=1)
+        self.buffer.x.copy_(x)
+        self._logs.copy_(logs)
         self.current_index = old_buffer['current_index']
         self.is_full = old_buffer['is_full']
         self.can_sample = old_buffer['can_sample']
+        if self._sum_tree is not None:
+            max_index = self.max_length if self.is_full else self.current_index
+            self._sum_tree.rebuild(self.buffer.log_w[:max_index])
 
 
 
@@ -0,0 +1,103 @@
+import os
+import tempfile
+
+import torch
+
+from fab.utils.prioritised_replay_buffer import PrioritisedReplayBuffer
+
+dim = 3
+max_length = 8
+batch_size = 4
+
+
+def make_buffer(**kwargs):
+    initial_sampler = lambda: (torch.randn(batch_size, dim), torch.randn(batch_size),
+                               torch.randn(batch_size))
+    return PrioritisedReplayBuffer(dim, max_length, min_sample_length=batch_size,
+                                   initial_sampler=initial_sampler, **kwargs)
+
+
+def test_adjust():
+    for sample_with_replacement in (False, True):
+        buffer = make_buffer(sample_with_replacement=sample_with_replacement)
+        indices = torch.arange(batch_size)
+        log_w_old = buffer.buffer.log_w[indices].clone()
+        log_q_old = buffer.buffer.log_q_old[indices].clone()
+        log_w_adjustment = torch.tensor([0.5, float("nan"), -1.0, 2.0])
+        log_q = torch.tensor([1.0, 2.0, float("inf"), 3.0])
+        valid = torch.tensor([True, False, False, True])
+        buffer.adjust(log_w_adjustment, log_q, indices)
+
+        log_w_new = buffer.buffer.log_w[indices]
+        log_q_new = buffer.buffer.log_q_old[indices]
+        assert torch.allclose(log_w_new[valid], (log_w_old + log_w_adjustment)[valid])
+        assert torch.equal(log_q_new[valid], log_q[valid])
+        assert torch.isneginf(log_w_new[~valid]).all()
+        assert torch.equal(log_q_new[~valid], log_q_old[~valid])
+
+        # Killed points are never sampled.
+        if sample_with_replacement:
+            _, _, _, sampled_indices = buffer.sample(1000)
+            assert torch.isin(sampled_indices, indices[valid]).all()
+
+
+def test_save_load_layouts():
+    # Save packed and load unpacked, and vice versa.
+    for save_kwargs, load_kwargs in (({}, {'x_dtype': torch.float64}),
+                                     ({'x_dtype': torch.float64}, {})):
+        buffer = make_buffer(**save_kwargs)
+        loaded_buffer = make_buffer(fill_buffer_during_init=False, **load_kwargs)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'buffer.pt')
+            buffer.save(path)
+            loaded_buffer.load(path)
+        assert torch.equal(loaded_buffer.buffer.x.float(), buffer.buffer.x.float())
+        assert torch.equal(loaded_buffer.buffer.log_w, buffer.buffer.log_w)
+        assert torch.equal(loaded_buffer.buffer.log_q_old, buffer.buffer.log_q_old)
+        assert loaded_buffer.current_index == buffer.current_index
+        assert loaded_buffer.is_full == buffer.is_full
+        assert loaded_buffer.can_sample == buffer.can_sample
+
+
+def test_load_legacy_format():
+    legacy_buffer = {'x': torch.randn(max_length, dim),
+                     'log_w': torch.randn(max_length),
+                     'log_q_old': torch.randn(max_length),
+                     'current_index': 5,
+                     'is_full': False,
+                     'can_sample': True}
+    buffer = make_buffer(fill_buffer_during_init=False)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'buffer.pt')
+        torch.save(legacy_buffer, path)
+        buffer.load(path)
+    assert torch.equal(buffer.buffer.x, legacy_buffer['x'])
+    assert torch.equal(buffer.buffer.log_w, legacy_buffer['log_w'])
+    assert torch.equal(buffer.buffer.log_q_old, legacy_buffer['log_q_old'])
+    assert buffer.current_index == 5
+    assert not buffer.is_full
+    assert buffer.can_sample
+
+
+def test_sample_n_batches():
+    n_batches = 2
+    sample_batch_size = batch_size // n_batches
+    for kwargs in ({}, {'x_dtype': torch.float64}, {'sample_with_replacement': True}):
+        buffer = make_buffer(**kwargs)
+        batches = buffer.sample_n_batches(sample_batch_size, n_batches)
+        assert len(batches) == n_batches
+        for x, log_w, log_q_old, indices in batches:
+            assert x.shape == (sample_batch_size, dim)
+            assert x.dtype == torch.get_default_dtype()
+            assert log_w.shape == (sample_batch_size,)
+            assert log_q_old.shape == (sample_batch_size,)
+            assert indices.shape == (sample_batch_size,)
+            assert torch.equal(x, buffer.buffer.x[indices].float())
+            assert torch.equal(log_w, buffer.buffer.log_w[indices])
+
+
+if __name__ == '__main__':
+    test_adjust()
+    test_save_load_layouts()
+    test_load_legacy_format()
+    test_sample_n_batches()
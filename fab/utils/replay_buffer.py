@@ -41,7 +41,6 @@ class ReplayBuffer:
         self.buffer = AISData(x=torch.zeros(self.max_length, dim).to(device),
                               log_w=torch.zeros(self.max_length, ).to(device),
                               add_count=torch.zeros(self.max_length, ).to(device))
-        self.possible_indices = torch.arange(self.max_length).to(device)
         self.device = device
         self.current_index = 0
         self.current_add_count = 0
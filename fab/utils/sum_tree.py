@@ -0,0 +1,63 @@
+import math
+
+import torch
+
+
+class LogSumTree:
+    def __init__(self, length: int, device: str = "cpu"):
+        """
+        Binary tree over `length` log weights, where each node holds the logsumexp of its children,
+        so the root holds the logsumexp of all leaves. Updating `B` leaves, or drawing `B` indices
+        with probability proportional to exp(log_w), costs O(B log N) rather than O(N).
+        Args:
+            length: number of leaves.
+            device: device of the tree.
+
+        Working in log space avoids the overflow that storing exp(log_w) directly would have.
+        Leaves that have not been set hold -inf and are never sampled.
+        """
+        self.length = length
+        self.depth = int(math.ceil(math.log2(length))) if length > 1 else 0
+        self.capacity = 2 ** self.depth
+        # Node 1 is the root, node i has children 2i and 2i + 1, leaves are nodes [capacity, 2 capacity).
+        self.tree = torch.full((2 * self.capacity,), -float("inf"), device=device)
+
+    @property
+    def log_total(self) -> torch.Tensor:
+        return self.tree[1]
+
+    @torch.no_grad()
+    def update(self, indices: torch.Tensor, log_w: torch.Tensor) -> None:
+        """Set the leaves at `indices` to `log_w` and recompute their ancestors. Repeated indices
+        must have equal `log_w`."""
+        node = indices + self.capacity
+        self.tree[node] = log_w
+        for _ in range(self.depth):
+            node = node // 2
+            self.tree[node] = torch.logaddexp(self.tree[2 * node], self.tree[2 * node + 1])
+
+    @torch.no_grad()
+    def rebuild(self, log_w: torch.Tensor) -> None:
+        """Set the first log_w.shape[0] leaves to `log_w`, the remaining leaves to -inf, and
+        recompute the whole tree."""
+        leaves = self.tree[self.capacity:]
+        leaves.fill_(-float("inf"))
+        leaves[:log_w.shape[0]] = log_w
+        for level in reversed(range(self.depth)):
+            children = self.tree[2 ** (level + 1): 2 ** (level + 2)]
+            self.tree[2 ** level: 2 ** (level + 1)] = torch.logaddexp(children[0::2], children[1::2])
+
+    @torch.no_grad()
+    def sample(self, n: int) -> torch.Tensor:
+        """Draw `n` leaf indices with replacement, with probability proportional to exp(log_w)."""
+        device = self.tree.device
+        node = torch.ones(n, dtype=torch.long, device=device)
+        u = torch.rand(self.depth, n, device=device)
+        for level in range(self.depth):
+            left = 2 * node
+            # Step left with probability p(left subtree | node). Never step into an empty right
+            # subtree, which rounding in p_left could otherwise allow.
+            p_left = torch.exp(self.tree[left] - self.tree[node])
+            go_left = (u[level] < p_left) | torch.isneginf(self.tree[left + 1])
+            node = torch.where(go_left, left, left + 1)
+        return node - self.capacity
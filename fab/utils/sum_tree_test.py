@@ -0,0 +1,31 @@
+import torch
+
+from fab.utils.sum_tree import LogSumTree
+
+
+def test_log_sum_tree():
+    torch.manual_seed(0)
+    length = 10
+    n_samples = 100000
+    log_w = torch.randn(length)
+    tree = LogSumTree(length)
+    tree.update(torch.arange(length), log_w)
+    assert torch.allclose(tree.log_total, torch.logsumexp(log_w, dim=0))
+
+    # Updating some leaves and rebuilding from scratch should give the same tree.
+    indices = torch.tensor([1, 4, 4, 7])
+    log_w[indices] = torch.tensor([2.0, -1.0, -1.0, -float("inf")])
+    tree.update(indices, log_w[indices])
+    rebuilt_tree = LogSumTree(length)
+    rebuilt_tree.rebuild(log_w)
+    assert torch.allclose(tree.tree, rebuilt_tree.tree)
+
+    samples = tree.sample(n_samples)
+    assert samples.min() >= 0 and samples.max() < length
+    assert (samples != 7).all()
+    empirical_probs = torch.bincount(samples, minlength=length) / n_samples
+    assert torch.allclose(empirical_probs, torch.softmax(log_w, dim=0), atol=0.01)
+
+
+if __name__ == '__main__':
+    test_log_sum_tree()
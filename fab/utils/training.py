@@ -1,4 +1,6 @@
 import os
+import queue
+import threading
 
 import yaml
 import numpy as np
@@ -50,4 +52,93 @@ class DatasetIterator:
         return self
 
     def __len__(self):
-        return self.n_splits
\ No newline at end of file
+        return self.n_splits
+
+class Prefetcher:
+    """Iterate endlessly through a data loader, while copying the next batch to the device
+    on a separate CUDA stream so that the copy overlaps with the computation on the
+    current batch. On the CPU the batches are just returned in order."""
+    def __init__(self, loader: torch.utils.data.DataLoader, device: torch.device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self.loader_iter = iter(loader)
+        self.next_batch = None
+        self._preload()
+
+    def _preload(self):
+        try:
+            batch = next(self.loader_iter)
+        except StopIteration:
+            self.loader_iter = iter(self.loader)
+            batch = next(self.loader_iter)
+        if self.stream is None:
+            self.next_batch = batch.to(self.device)
+        else:
+            with torch.cuda.stream(self.stream):
+                self.next_batch = batch.to(self.device, non_blocking=True)
+
+    def __next__(self):
+        batch = self.next_batch
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            # Prevent the memory from being reused before the current stream is done with it
+            batch.record_stream(current_stream)
+        self._preload()
+        return batch
+
+    def __iter__(self):
+        return self
+
+
+def _clone_to_cpu(obj):
+    """Recursively copy all tensors within a (nested) state dict to the CPU."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: _clone_to_cpu(val) for key, val in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_clone_to_cpu(val) for val in obj)
+    return obj
+
+
+class AsyncCheckpointWriter:
+    """Write state dicts to disk with `torch.save` in a background thread, so that training
+    can continue while the checkpoint is being written. The state is copied to the CPU when
+    it is submitted, hence it may be modified right afterwards. Each file is written to a
+    temporary path first and then moved into place, so an interrupted write does not leave a
+    corrupt checkpoint behind. The first failed write is raised by the next call of `save`
+    or `join`."""
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def _write(self):
+        while True:
+            state, path = self.queue.get()
+            try:
+                tmp_path = path + '.tmp'
+                torch.save(state, tmp_path)
+                os.replace(tmp_path, path)
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def save(self, state, path):
+        """Submit a state dict to be saved at path."""
+        self._raise_error()
+        self.queue.put((_clone_to_cpu(state), str(path)))
+
+    def join(self):
+        """Wait until all submitted checkpoints are written."""
+        self.queue.join()
+        self._raise_error()
@@ -0,0 +1,36 @@
+import os
+import tempfile
+
+import torch
+
+from fab.utils.training import AsyncCheckpointWriter
+
+
+def test_async_checkpoint_writer():
+    writer = AsyncCheckpointWriter()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'optimizer.pt')
+        state = {'step': 3, 'params': [torch.ones(2)]}
+        writer.save(state, path)
+        # The state is copied on submission, so it may be modified straight away.
+        state['params'][0] += 1
+        writer.join()
+        assert not os.path.exists(path + '.tmp')
+        loaded = torch.load(path)
+        assert loaded['step'] == 3
+        assert torch.equal(loaded['params'][0], torch.ones(2))
+
+        # A failed write is raised by join, and by any later save.
+        bad_path = os.path.join(tmp_dir, 'missing_dir', 'optimizer.pt')
+        writer.save(state, bad_path)
+        for submit in (writer.join, lambda: writer.save(state, path)):
+            try:
+                submit()
+            except Exception:
+                pass
+            else:
+                raise AssertionError("Write error was not raised")
+
+
+if __name__ == '__main__':
+    test_async_checkpoint_writer()